@@ -116,8 +116,35 @@ class CloudGAN(pl.LightningModule):
         # define loss functions
         self.criterionGAN = GANLoss(loss)
         self.criterionL1 = get_loss(l1_loss, channels=self.channels_per_timestep)
+        # Generator output of the last generator step, reused by the discriminator step
+        self.generated_cache = None
         self.save_hyperparameters()
 
+    def cache_generated(self, generated_images: torch.Tensor, batch_idx: int):
+        """Keep the detached generator output, so the discriminator step can reuse it"""
+        self.generated_cache = (batch_idx, generated_images.detach())
+
+    def generate_for_discriminator(self, images: torch.Tensor, batch_idx: int, **kwargs):
+        """
+        Get the generated images for the discriminator step
+
+        The generator step on the same batch runs first, so its detached output is reused
+        instead of running the generator forward again
+
+        Args:
+            images: Input images
+            batch_idx: Index of the current batch
+            **kwargs: Passed to the generator if there is no cached output for this batch
+
+        Returns:
+            Detached generated images
+        """
+        cache, self.generated_cache = self.generated_cache, None
+        if cache is not None and cache[0] == batch_idx:
+            return cache[1]
+        with torch.no_grad():
+            return self(images, **kwargs)
+
     def train_per_timestep(
         self, images: torch.Tensor, future_images: torch.Tensor, optimizer_idx: int, batch_idx: int
     ):
@@ -141,10 +168,11 @@ class CloudGAN(pl.LightningModule):
             generated_images = self(
                 images, forecast_steps=self.forecast_steps
             )  # (Batch, Channel, Width, Height)
+            self.cache_generated(generated_images, batch_idx)
             for i in range(self.forecast_steps):
                 # x = self.ct.forward(images, i)  # Condition on future timestep
                 # fake = self(x, forecast_steps=i + 1)  # (Batch, Channel, Width, Height)
-                fake = generated_images[:, :, i, :, :]  # Only take the one at the end
+                fake = generated_images[:, i]  # Only take the one at the end
                 if vis_step:
                     self.visualize_step(
                         images, future_images[:, i, :, :], fake, batch_idx, step=f"train_frame_{i}"
@@ -167,13 +195,13 @@ class CloudGAN(pl.LightningModule):
             # Measure discriminator's ability to classify real from generated samples
             # generate images
             total_loss = 0
-            generated_images = self(
-                images, forecast_steps=self.forecast_steps
+            generated_images = self.generate_for_discriminator(
+                images, batch_idx, forecast_steps=self.forecast_steps
             )  # (Batch, Channel, Width, Height)
             for i in range(self.forecast_steps):
                 # x = self.ct.forward(images, i)  # Condition on future timestep
                 # fake = self(x, forecast_steps=i + 1)  # (Batch, Channel, Width, Height)
-                fake = generated_images[:, :, i, :, :]  # Only take the one at the end
+                fake = generated_images[:, i]  # Only take the one at the end
                 real_loss = self.criterionGAN(self.discriminator(future_images[:, i, :, :]), True)
                 # adversarial loss is binary cross-entropy
                 fake_loss = self.criterionGAN(self.discriminator(fake), False)
@@ -205,6 +233,7 @@ class CloudGAN(pl.LightningModule):
         if optimizer_idx == 0:
             # generate images
             generated_images = self(images)
+            self.cache_generated(generated_images, batch_idx)
             fake = torch.cat((images, generated_images), 1)
             # log sampled images
             if np.random.random() < 0.01:
@@ -230,7 +259,7 @@ class CloudGAN(pl.LightningModule):
             real_loss = self.criterionGAN(self.discriminator(real), True)
 
             # how well can it label as fake?
-            gen_output = self(images)
+            gen_output = self.generate_for_discriminator(images, batch_idx)
             fake = torch.cat((images, gen_output), 1)
             fake_loss = self.criterionGAN(self.discriminator(fake), False)
 
@@ -254,8 +283,10 @@ class CloudGAN(pl.LightningModule):
         # log sampled images
         if np.random.random() < 0.01:
             self.visualize_step(images, future_images, generated_images, batch_idx, step="val")
+        # Both the generator and discriminator losses use the same prediction on the fakes
+        fake_prediction = self.discriminator(fake)
         # adversarial loss is binary cross-entropy
-        gan_loss = self.criterionGAN(self.discriminator(fake), True)
+        gan_loss = self.criterionGAN(fake_prediction, True)
         l1_loss = self.criterionL1(generated_images, future_images) * self.lambda_l1
         g_loss = gan_loss + l1_loss
         # how well can it label as real?
@@ -263,7 +294,7 @@ class CloudGAN(pl.LightningModule):
         real_loss = self.criterionGAN(self.discriminator(real), True)
 
         # how well can it label as fake?
-        fake_loss = self.criterionGAN(self.discriminator(fake), True)
+        fake_loss = self.criterionGAN(fake_prediction, True)
 
         # discriminator loss is the average of these
         d_loss = (real_loss + fake_loss) / 2
@@ -288,18 +319,19 @@ class CloudGAN(pl.LightningModule):
         )  # (Batch, Channel, Width, Height)
         for i in range(self.forecast_steps):
             # x = self.ct.forward(images, i)  # Condition on future timestep
-            fake = generated_images[:, :, i, :, :]  # Only take the one at the end
+            fake = generated_images[:, i]  # Only take the one at the end
             if vis_step:
                 self.visualize_step(
                     images, future_images[:, i, :, :], fake, batch_idx, step=f"val_frame_{i}"
                 )
+            fake_prediction = self.discriminator(fake)
             # adversarial loss is binary cross-entropy
-            gan_loss = self.criterionGAN(self.discriminator(fake), True)
+            gan_loss = self.criterionGAN(fake_prediction, True)
             # Only L1 loss on the given timestep
             l1_loss = self.criterionL1(fake, future_images[:, i, :, :]) * self.lambda_l1
             real_loss = self.criterionGAN(self.discriminator(future_images[:, i, :, :]), True)
             # adversarial loss is binary cross-entropy
-            fake_loss = self.criterionGAN(self.discriminator(fake), False)
+            fake_loss = self.criterionGAN(fake_prediction, False)
             # Only L1 loss on the given timestep
             # discriminator loss is the average of these
             d_loss = (real_loss + fake_loss) / 2
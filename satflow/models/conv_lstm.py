@@ -1,13 +1,107 @@
-from typing import Any, Dict, Union
+import inspect
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Union
 
 import pytorch_lightning as pl
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision
 from nowcasting_utils.models.base import register_model
 from nowcasting_utils.models.loss import get_loss
 
-from satflow.models.layers.ConvLSTM import ConvLSTMCell
+from satflow.models.layers.ConvLSTM import ConvLSTMCell, conv_lstm_gates, conv_lstm_step
+
+logger = logging.getLogger("satflow.model")
+
+
+@torch.jit.script
+def run_autoencoder(
+    x: torch.Tensor,
+    seq_len: int,
+    future_step: int,
+    h_t: torch.Tensor,
+    c_t: torch.Tensor,
+    h_t2: torch.Tensor,
+    c_t2: torch.Tensor,
+    h_t3: torch.Tensor,
+    c_t3: torch.Tensor,
+    h_t4: torch.Tensor,
+    c_t4: torch.Tensor,
+    weight_1: torch.Tensor,
+    bias_1: Optional[torch.Tensor],
+    weight_2: torch.Tensor,
+    bias_2: Optional[torch.Tensor],
+    weight_3: torch.Tensor,
+    bias_3: Optional[torch.Tensor],
+    weight_4: torch.Tensor,
+    bias_4: Optional[torch.Tensor],
+    padding: List[int],
+) -> torch.Tensor:
+    """
+    Scripted encoder/decoder recurrence of the ConvLSTM, on plain tensors only
+
+    Returns:
+        Stacked decoder hidden states of shape (B, future_step, C_hidden, H, W)
+    """
+    outputs: List[torch.Tensor] = []
+
+    # The input half of the first encoder conv does not depend on the recurrent state,
+    # so it is run once over all timesteps folded into the batch
+    b, _, input_dim, h, w = x.size()
+    x = x.reshape(b * seq_len, input_dim, h, w).contiguous(memory_format=torch.channels_last)
+    input_conv = F.conv2d(x, weight_1[:, :input_dim], bias_1, padding=padding)
+    input_conv = input_conv.view(b, seq_len, input_conv.size(1), h, w)
+    hidden_weight_1 = weight_1[:, input_dim:].contiguous(memory_format=torch.channels_last)
+
+    # encoder
+    for t in range(seq_len):
+        hidden_conv = F.conv2d(h_t, hidden_weight_1, None, padding=padding)
+        h_t, c_t = conv_lstm_gates(input_conv[:, t] + hidden_conv, c_t)
+        h_t2, c_t2 = conv_lstm_step(h_t, h_t2, c_t2, weight_2, bias_2, padding)
+
+    # encoder_vector
+    encoder_vector = h_t2
+
+    # decoder
+    for t in range(future_step):
+        h_t3, c_t3 = conv_lstm_step(encoder_vector, h_t3, c_t3, weight_3, bias_3, padding)
+        h_t4, c_t4 = conv_lstm_step(h_t3, h_t4, c_t4, weight_4, bias_4, padding)
+        encoder_vector = h_t4
+        outputs.append(h_t4)  # predictions
+
+    return torch.stack(outputs, 1)
+
+
+def log_visualize_error(future: Future):
+    """Log the exception, if any, raised while writing visualizations on the background thread"""
+    exception = future.exception()
+    if exception is not None:
+        logger.error("Writing ConvLSTM visualizations failed", exc_info=exception)
+
+
+# Each captured CUDA graph keeps its own static memory pool, so only a couple of input shapes
+# are kept, enough for the training batch and a smaller final batch of an epoch
+MAX_CUDA_GRAPHS = 2
+
+# fused is only available from torch 1.13, and foreach from torch 1.12
+ADAM_PARAMETERS = inspect.signature(torch.optim.Adam).parameters
+
+# Elementwise losses built directly as modules, other names go through get_loss
+LOSSES = {"mse": nn.MSELoss, "bce": nn.BCELoss, "l1": nn.L1Loss}
+
+
+class FixedForecastConvLSTM(nn.Module):
+    """Binds the number of forecast steps, so the ConvLSTM forward only takes tensors"""
+
+    def __init__(self, model: "ConvLSTM", forecast_steps: int):
+        super().__init__()
+        self.model = model
+        self.forecast_steps = forecast_steps
+
+    def forward(self, x):
+        return self.model(x, self.forecast_steps)
 
 
 @register_model
@@ -23,13 +117,34 @@ class EncoderDecoderConvLSTM(pl.LightningModule):
         loss: Union[str, torch.nn.Module] = "mse",
         pretrained: bool = False,
         conv_type: str = "standard",
+        cuda_graphs: bool = False,
+        frame_loss_log_interval: int = 1,
     ):
         super(EncoderDecoderConvLSTM, self).__init__()
         self.forecast_steps = forecast_steps
-        self.criterion = get_loss(loss)
+        if isinstance(loss, nn.Module):
+            self.criterion = loss
+        else:
+            self.criterion = LOSSES[loss]() if loss in LOSSES else get_loss(loss)
+        # Unreduced version of the criterion, to get all the per-frame losses in one call
+        self.frame_criterion = LOSSES[loss](reduction="none") if loss in LOSSES else None
+        # Only log the per-frame training losses every this many batches
+        if frame_loss_log_interval < 1:
+            raise ValueError(
+                f"frame_loss_log_interval must be at least 1, not {frame_loss_log_interval}"
+            )
+        self.frame_loss_log_interval = frame_loss_log_interval
         self.lr = lr
         self.visualize = visualize
+        self.input_channels = input_channels
+        self.output_channels = out_channels
+        # Created on first use, writes the TensorBoard images off the training thread
+        self.visualize_pool: Optional[ThreadPoolExecutor] = None
         self.model = ConvLSTM(input_channels, hidden_dim, out_channels, conv_type=conv_type)
+        # Captured CUDA graphs of the training forward and backward, one per input shape, at most
+        # MAX_CUDA_GRAPHS of them
+        self.cuda_graphs = cuda_graphs
+        self.graphed_models: Dict[tuple, nn.Module] = {}
         self.save_hyperparameters()
 
     @classmethod
@@ -43,79 +158,157 @@ class EncoderDecoderConvLSTM(pl.LightningModule):
         )
 
     def forward(self, x, future_seq=0, hidden_state=None):
+        if (
+            self.cuda_graphs
+            and x.is_cuda
+            and hidden_state is None
+            and self.training
+            and torch.is_grad_enabled()
+            and not torch.is_autocast_enabled()
+        ):
+            return self.graphed_forward(x, future_seq)
         return self.model.forward(x, future_seq, hidden_state)
 
+    def graphed_forward(self, x, forecast_steps):
+        """
+        Run the ConvLSTM forward and backward as replays of CUDA graphs
+
+        The recurrent loop launches several kernels per cell per timestep, which dominates
+        at small spatial sizes. Graphs are captured after warmup iterations the first time
+        a shape is seen, and replayed afterwards with the batch copied into static inputs.
+
+        Args:
+            x: Input tensor of shape (B, T, C, H, W)
+            forecast_steps: Number of future timesteps to predict
+
+        Returns:
+            The ConvLSTM predictions
+        """
+        key = (tuple(x.shape), x.dtype, forecast_steps)
+        if key not in self.graphed_models:
+            if len(self.graphed_models) >= MAX_CUDA_GRAPHS:
+                # Drop the oldest graph, and its memory pool, to bound the memory used
+                self.graphed_models.pop(next(iter(self.graphed_models)))
+            self.graphed_models[key] = torch.cuda.make_graphed_callables(
+                FixedForecastConvLSTM(self.model, forecast_steps), (x.clone(),)
+            )
+        return self.graphed_models[key](x)
+
     def configure_optimizers(self):
         # DeepSpeedCPUAdam provides 5x to 7x speedup over torch.optim.adam(w)
         # optimizer = torch.optim.adam()
-        return torch.optim.Adam(self.parameters(), lr=self.lr)
+        # The fused CUDA Adam updates all the small ConvLSTM parameters in a single kernel,
+        # otherwise fall back to the multi-tensor implementation where this torch has them
+        kwargs = {}
+        if self.device.type == "cuda" and "fused" in ADAM_PARAMETERS:
+            kwargs["fused"] = True
+        elif "foreach" in ADAM_PARAMETERS:
+            kwargs["foreach"] = True
+        return torch.optim.Adam(self.parameters(), lr=self.lr, **kwargs)
 
     def training_step(self, batch, batch_idx):
         x, y = batch
         y_hat = self(x, self.forecast_steps)
-        y_hat = torch.permute(y_hat, dims=(0, 2, 1, 3, 4))
         # Generally only care about the center x crop, so the model can take into account the clouds in the area without
         # being penalized for that, but for now, just do general MSE loss, also only care about first 12 channels
         # the logger you used (in this case tensorboard)
         # if self.visualize:
         #    if np.random.random() < 0.01:
         #        self.visualize_step(x, y, y_hat, batch_idx)
-        loss = self.criterion(y_hat, y)
+        # Losses are computed in fp32 with autocast off, BCELoss is not autocast safe
+        with torch.autocast(device_type=y_hat.device.type, enabled=False):
+            y_hat = y_hat.float()
+            loss = self.criterion(y_hat, y)
+            log_frames = batch_idx % self.frame_loss_log_interval == 0
+            frame_losses = self.frame_losses(y_hat, y) if log_frames else None
         self.log("train/loss", loss, on_step=True)
-        frame_loss_dict = {}
-        for f in range(self.forecast_steps):
-            frame_loss = self.criterion(y_hat[:, f, :, :, :], y[:, f, :, :, :]).item()
-            frame_loss_dict[f"train/frame_{f}_loss"] = frame_loss
-        self.log_dict(frame_loss_dict, on_step=False, on_epoch=True)
+        if frame_losses is not None:
+            # Logged as device tensors, Lightning only syncs them when reducing at epoch end
+            frame_losses = frame_losses.unbind()
+            frame_loss_dict = {f"train/frame_{f}_loss": l for f, l in enumerate(frame_losses)}
+            self.log_dict(frame_loss_dict, on_step=False, on_epoch=True)
         return loss
 
     def validation_step(self, batch, batch_idx):
         x, y = batch
         y_hat = self(x, self.forecast_steps)
-        y_hat = torch.permute(y_hat, dims=(0, 2, 1, 3, 4))
-        val_loss = self.criterion(y_hat, y)
-        # Save out loss per frame as well
-        frame_loss_dict = {}
-        # y_hat = torch.moveaxis(y_hat, 2, 1)
-        for f in range(self.forecast_steps):
-            frame_loss = self.criterion(y_hat[:, f, :, :, :], y[:, f, :, :, :]).item()
-            frame_loss_dict[f"val/frame_{f}_loss"] = frame_loss
+        # Losses are computed in fp32 with autocast off, BCELoss is not autocast safe
+        with torch.autocast(device_type=y_hat.device.type, enabled=False):
+            y_hat = y_hat.float()
+            val_loss = self.criterion(y_hat, y)
+            # Save out loss per frame as well
+            frame_losses = self.frame_losses(y_hat, y).unbind()
+        frame_loss_dict = {f"val/frame_{f}_loss": l for f, l in enumerate(frame_losses)}
         self.log("val/loss", val_loss, on_step=True, on_epoch=True)
         self.log_dict(frame_loss_dict, on_step=False, on_epoch=True)
         return val_loss
 
+    def frame_losses(self, y_hat: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+        """
+        Compute the loss for every forecast frame, only used for logging
+
+        Args:
+            y_hat: Predictions of shape (B, T, C, H, W)
+            y: Targets of shape (B, T, C, H, W)
+
+        Returns:
+            Tensor of shape (T,) with the loss for each frame
+        """
+        y_hat = y_hat.detach()
+        if self.frame_criterion is not None:
+            # A single elementwise kernel for all frames, instead of one criterion call each
+            return self.frame_criterion(y_hat, y).mean(dim=(0, 2, 3, 4))
+        return torch.stack([self.criterion(y_hat[:, f], y[:, f]) for f in range(y_hat.size(1))])
+
     def test_step(self, batch, batch_idx):
         x, y = batch
         y_hat = self(x, self.forecast_steps)
-        loss = self.criterion(y_hat, y)
+        with torch.autocast(device_type=y_hat.device.type, enabled=False):
+            loss = self.criterion(y_hat.float(), y)
         return loss
 
     def visualize_step(self, x, y, y_hat, batch_idx, step="train"):
         tensorboard = self.logger.experiment[0]
         # Add all the different timesteps for a single prediction, 0.1% of the time
         if len(x.shape) == 5:
-            # Timesteps per channel
-            images = x[0].cpu().detach()
-            for i, t in enumerate(images):  # Now would be (C, H, W)
-                t = [torch.unsqueeze(img, dim=0) for img in t]
-                image_grid = torchvision.utils.make_grid(t, nrow=self.input_channels)
-                tensorboard.add_image(
-                    f"{step}/Input_Image_Stack_Frame_{i}", image_grid, global_step=batch_idx
-                )
-            images = y[0].cpu().detach()
-            for i, t in enumerate(images):  # Now would be (C, H, W)
-                t = [torch.unsqueeze(img, dim=0) for img in t]
-                image_grid = torchvision.utils.make_grid(t, nrow=self.output_channels)
-                tensorboard.add_image(
-                    f"{step}/Target_Image_Stack_Frame_{i}", image_grid, global_step=batch_idx
-                )
-            images = y_hat[0].cpu().detach()
+            # Start the device to host copies without waiting on them, the image encoding and
+            # writing happens on a background thread once the copies are done
+            images = [t[0].detach().to("cpu", non_blocking=True) for t in (x, y, y_hat)]
+            copied = None
+            if x.is_cuda:
+                copied = torch.cuda.Event()
+                copied.record()
+            if self.visualize_pool is None:
+                self.visualize_pool = ThreadPoolExecutor(max_workers=1)
+            future = self.visualize_pool.submit(
+                self.write_images, tensorboard, *images, copied, batch_idx, step
+            )
+            future.add_done_callback(log_visualize_error)
+
+    def write_images(self, tensorboard, x, y, y_hat, copied, batch_idx, step):
+        """
+        Write one image grid per timestep for the input, target and generated stacks
+
+        Args:
+            tensorboard: TensorBoard SummaryWriter
+            x: Input stack of shape (T, C, H, W)
+            y: Target stack of shape (T, C, H, W)
+            y_hat: Generated stack of shape (T, C, H, W)
+            copied: CUDA event recorded after the device to host copies, if any
+            batch_idx: Global step for the images
+            step: Prefix for the image names
+        """
+        if copied is not None:
+            copied.synchronize()
+        for images, name, nrow in (
+            (x, "Input_Image_Stack", self.input_channels),
+            (y, "Target_Image_Stack", self.output_channels),
+            (y_hat, "Generated_Stack", self.output_channels),
+        ):
             for i, t in enumerate(images):  # Now would be (C, H, W)
                 t = [torch.unsqueeze(img, dim=0) for img in t]
-                image_grid = torchvision.utils.make_grid(t, nrow=self.output_channels)
-                tensorboard.add_image(
-                    f"{step}/Generated_Stack_Frame_{i}", image_grid, global_step=batch_idx
-                )
+                image_grid = torchvision.utils.make_grid(t, nrow=nrow)
+                tensorboard.add_image(f"{step}/{name}_Frame_{i}", image_grid, global_step=batch_idx)
 
 
 class ConvLSTM(torch.nn.Module):
@@ -126,7 +319,7 @@ class ConvLSTM(torch.nn.Module):
         # Encoder (ConvLSTM)
         # Encoder Vector (final hidden state of encoder)
         # Decoder (ConvLSTM) - takes Encoder Vector as input
-        # Decoder (3D CNN) - produces regression predictions for our model
+        # Decoder (CNN per timestep) - produces regression predictions for our model
 
         """
         self.encoder_1_convlstm = ConvLSTMCell(
@@ -161,15 +354,62 @@ class ConvLSTM(torch.nn.Module):
             conv_type=conv_type,
         )
 
-        self.decoder_CNN = nn.Conv3d(
+        # Applied to every timestep separately, so run as a 2D conv over time folded into the batch
+        self.decoder_CNN = nn.Conv2d(
             in_channels=hidden_dim,
             out_channels=out_channels,
-            kernel_size=(1, 3, 3),
-            padding=(0, 1, 1),
+            kernel_size=(3, 3),
+            padding=(1, 1),
         )
 
+        # NHWC lets cuDNN pick the tensor core kernels for the recurrent convolutions
+        self.encoder_1_convlstm.to(memory_format=torch.channels_last)
+        self.encoder_2_convlstm.to(memory_format=torch.channels_last)
+        self.decoder_1_convlstm.to(memory_format=torch.channels_last)
+        self.decoder_2_convlstm.to(memory_format=torch.channels_last)
+        self.decoder_CNN.to(memory_format=torch.channels_last)
+
+        # The scripted recurrence only works with plain convolutions, CoordConv adds channels
+        self.cells = [
+            self.encoder_1_convlstm,
+            self.encoder_2_convlstm,
+            self.decoder_1_convlstm,
+            self.decoder_2_convlstm,
+        ]
+        self.scripted = all(type(cell.conv) is nn.Conv2d for cell in self.cells)
+        # Zero initial states, cached per shape, device and dtype
+        self.zero_states: Dict[tuple, torch.Tensor] = {}
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints from before the decoder was a Conv2d store a (out, hidden, 1, 3, 3) weight
+        key = prefix + "decoder_CNN.weight"
+        if key in state_dict and state_dict[key].dim() == 5:
+            state_dict[key] = state_dict[key].squeeze(2)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def autoencoder(self, x, seq_len, future_step, h_t, c_t, h_t2, c_t2, h_t3, c_t3, h_t4, c_t4):
 
+        if self.scripted:
+            weights_and_biases = []
+            for cell in self.cells:
+                weights_and_biases += [cell.conv.weight, cell.conv.bias]
+            outputs = run_autoencoder(
+                x,
+                seq_len,
+                future_step,
+                h_t,
+                c_t,
+                h_t2,
+                c_t2,
+                h_t3,
+                c_t3,
+                h_t4,
+                c_t4,
+                *weights_and_biases,
+                list(self.encoder_1_convlstm.padding),
+            )
+            return self.decode(outputs)
+
         outputs = []
 
         # encoder
@@ -196,9 +436,14 @@ class ConvLSTM(torch.nn.Module):
             outputs += [h_t4]  # predictions
 
         outputs = torch.stack(outputs, 1)
-        outputs = outputs.permute(0, 2, 1, 3, 4)
-        outputs = self.decoder_CNN(outputs)
-        outputs = torch.nn.Sigmoid()(outputs)
+        return self.decode(outputs)
+
+    def decode(self, outputs):
+        """Maps stacked (B, T, C_hidden, H, W) decoder states to (B, T, C_out, H, W) outputs"""
+        b, t, hidden_dim, h, w = outputs.size()
+        outputs = self.decoder_CNN(outputs.reshape(b * t, hidden_dim, h, w))
+        outputs = outputs.reshape(b, t, -1, h, w)
+        outputs = torch.sigmoid(outputs)
 
         return outputs
 
@@ -215,14 +460,40 @@ class ConvLSTM(torch.nn.Module):
         b, seq_len, _, h, w = x.size()
 
         # initialize hidden states
-        h_t, c_t = self.encoder_1_convlstm.init_hidden(batch_size=b, image_size=(h, w))
-        h_t2, c_t2 = self.encoder_2_convlstm.init_hidden(batch_size=b, image_size=(h, w))
-        h_t3, c_t3 = self.decoder_1_convlstm.init_hidden(batch_size=b, image_size=(h, w))
-        h_t4, c_t4 = self.decoder_2_convlstm.init_hidden(batch_size=b, image_size=(h, w))
+        zeros = self.zero_state(batch_size=b, image_size=(h, w))
 
         # autoencoder forward
-        outputs = self.autoencoder(
-            x, seq_len, forecast_steps, h_t, c_t, h_t2, c_t2, h_t3, c_t3, h_t4, c_t4
-        )
+        outputs = self.autoencoder(x, seq_len, forecast_steps, *([zeros] * 8))
 
         return outputs
+
+    def zero_state(self, batch_size, image_size):
+        """
+        Get the zero tensor used as every initial hidden and cell state
+
+        The cells never write to their states in place, so one cached tensor per shape can be
+        shared by all of them, instead of allocating eight new ones every forward. This also
+        keeps the initial states at fixed addresses for CUDA graph capture.
+
+        Args:
+            batch_size: Batch size
+            image_size: Height and width of the states
+
+        Returns:
+            Zero tensor of shape (batch_size, hidden_dim, height, width)
+        """
+        height, width = image_size
+        weight = self.decoder_CNN.weight
+        # Tensors created in inference mode cannot be saved for backward in training
+        key = (batch_size, height, width, weight.device, weight.dtype)
+        key += (torch.is_inference_mode_enabled(),)
+        if key not in self.zero_states:
+            self.zero_states[key] = torch.zeros(
+                batch_size,
+                self.decoder_CNN.in_channels,
+                height,
+                width,
+                device=weight.device,
+                dtype=weight.dtype,
+            ).contiguous(memory_format=torch.channels_last)
+        return self.zero_states[key]
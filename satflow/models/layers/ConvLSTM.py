@@ -1,9 +1,68 @@
+from typing import List, Optional, Tuple
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from satflow.models.utils import get_conv_layer
 
 
+@torch.jit.script
+def conv_lstm_gates(
+    combined_conv: torch.Tensor, c_cur: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Apply the LSTM gates to the summed input and hidden convolutions
+
+    Args:
+        combined_conv: Gate pre-activations of shape (B, 4 * C_hidden, H, W)
+        c_cur: Current cell state of shape (B, C_hidden, H, W)
+
+    Returns:
+        The next hidden and cell states
+    """
+    cc_i, cc_f, cc_o, cc_g = combined_conv.chunk(4, dim=1)
+    i = torch.sigmoid(cc_i)
+    f = torch.sigmoid(cc_f)
+    o = torch.sigmoid(cc_o)
+    g = torch.tanh(cc_g)
+
+    # The cell state stays in the precision it was initialised in, fp32 by default, so it does
+    # not drift over long sequences under mixed precision, while the hidden state follows the gates
+    c_next = f * c_cur + i * g
+    h_next = (o * torch.tanh(c_next)).to(o.dtype)
+
+    return h_next, c_next
+
+
+@torch.jit.script
+def conv_lstm_step(
+    input_tensor: torch.Tensor,
+    h_cur: torch.Tensor,
+    c_cur: torch.Tensor,
+    weight: torch.Tensor,
+    bias: Optional[torch.Tensor],
+    padding: List[int],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Single ConvLSTM step on plain tensors, scripted so the gate elementwise ops can be fused
+
+    Args:
+        input_tensor: Input of shape (B, C_in, H, W)
+        h_cur: Current hidden state of shape (B, C_hidden, H, W)
+        c_cur: Current cell state of shape (B, C_hidden, H, W)
+        weight: Convolution weight of shape (4 * C_hidden, C_in + C_hidden, kH, kW)
+        bias: Optional convolution bias of shape (4 * C_hidden)
+        padding: Padding for the convolution
+
+    Returns:
+        The next hidden and cell states
+    """
+    combined = torch.cat([input_tensor, h_cur], dim=1)  # concatenate along channel axis
+    combined_conv = F.conv2d(combined, weight, bias, padding=padding)
+    return conv_lstm_gates(combined_conv, c_cur)
+
+
 class ConvLSTMCell(nn.Module):
     def __init__(self, input_dim, hidden_dim, kernel_size, bias, conv_type: str = "standard"):
         """
@@ -42,23 +101,23 @@ class ConvLSTMCell(nn.Module):
     def forward(self, input_tensor, cur_state):
         h_cur, c_cur = cur_state
 
+        if type(self.conv) is nn.Conv2d:
+            return conv_lstm_step(
+                input_tensor, h_cur, c_cur, self.conv.weight, self.conv.bias, list(self.padding)
+            )
+
         combined = torch.cat([input_tensor, h_cur], dim=1)  # concatenate along channel axis
 
         combined_conv = self.conv(combined)
-        cc_i, cc_f, cc_o, cc_g = torch.split(combined_conv, self.hidden_dim, dim=1)
-        i = torch.sigmoid(cc_i)
-        f = torch.sigmoid(cc_f)
-        o = torch.sigmoid(cc_o)
-        g = torch.tanh(cc_g)
-
-        c_next = f * c_cur + i * g
-        h_next = o * torch.tanh(c_next)
-
-        return h_next, c_next
+        return conv_lstm_gates(combined_conv, c_cur)
 
     def init_hidden(self, batch_size, image_size):
         height, width = image_size
         return (
-            torch.zeros(batch_size, self.hidden_dim, height, width, device=self.conv.weight.device),
-            torch.zeros(batch_size, self.hidden_dim, height, width, device=self.conv.weight.device),
+            torch.zeros(
+                batch_size, self.hidden_dim, height, width, device=self.conv.weight.device
+            ).contiguous(memory_format=torch.channels_last),
+            torch.zeros(
+                batch_size, self.hidden_dim, height, width, device=self.conv.weight.device
+            ).contiguous(memory_format=torch.channels_last),
         )
@@ -44,20 +44,57 @@ HRV_KEY = "hrv_" + SATELLITE_DATA
 
 
 class HuggingFacePerceiver(BaseModel):
-    def __init__(self, input_size: int = 224):
+    def __init__(self, input_size: int = 224, lr: float = 0.001, compile_model: bool = False):
+        """
+        Pretrained optical flow Perceiver from HuggingFace
+
+        Args:
+            input_size: Height and width of the input images
+            lr: Learning rate
+            compile_model: Whether to torch.compile the Perceiver with CUDA graphs, for
+                fixed-shape inputs
+        """
+        super(BaseModel, self).__init__()
+        self.lr = lr
+        # The weights stay in fp32 for the optimizer, forward runs the Perceiver in bfloat16
         self.model = PerceiverForOpticalFlow.from_pretrained(
             "deepmind/optical-flow-perceiver",
             ignore_mismatched_sizes=True,
             train_size=[input_size, input_size],
+            low_cpu_mem_usage=True,
         )
+        if compile_model:
+            # Compiled in place, so the state_dict keys stay the same as the plain module
+            if hasattr(self.model, "compile"):
+                self.model.compile(mode="reduce-overhead")
+            else:
+                logger.warning("nn.Module.compile needs torch >= 2.2, not compiling the Perceiver")
 
-        self.channel_change = torch.nn.Conv2d(in_channels=2, out_channels=11)
+        self.channel_change = torch.nn.Conv2d(in_channels=2, out_channels=11, kernel_size=1)
         self.predict_satellite = False
         self.predict_hrv_satellite = True
-        self.hrv_channel_change = torch.nn.Conv2d(in_channels=2, out_channels=1)
+        self.hrv_channel_change = torch.nn.Conv2d(in_channels=2, out_channels=1, kernel_size=1)
 
     def forward(self, x, **kwargs) -> Any:
-        return model(inputs=x)
+        # The Perceiver runs in bfloat16, the rest of the model and the losses stay in fp32
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16):
+            flow = self.model(inputs=x).logits
+        # Flow logits are (B, H, W, 2), the channel change convs take (B, 2, H, W)
+        return flow.permute(0, 3, 1, 2).float()
+
+    def mse(self, y_hat: torch.Tensor, y: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Mean squared error over the whole prediction and for every predicted frame
+
+        Args:
+            y_hat: Predictions of shape (B, T, H, W)
+            y: Targets of the same shape
+
+        Returns:
+            The overall loss and a tensor of shape (T,) with the loss for each frame
+        """
+        squared_error = F.mse_loss(y_hat, y, reduction="none")
+        return squared_error.mean(), squared_error.detach().mean(dim=(0, 2, 3))
 
     def _train_or_validate_step(self, batch, batch_idx, is_training: bool = True):
         x, y = batch
@@ -65,13 +102,13 @@ class HuggingFacePerceiver(BaseModel):
         # Predicting all future ones at once
         losses = []
         if self.predict_satellite:
-            sat_y_hat = self.model(inputs=x)
+            sat_y_hat = self(x)
             sat_y_hat = self.channel_change(sat_y_hat)
             # Satellite losses
-            sat_loss, sat_frame_loss = self.mse(hrv_sat_y_hat, y[SATELLITE_DATA])
+            sat_loss, sat_frame_loss = self.mse(sat_y_hat, y[SATELLITE_DATA])
             losses.append(sat_loss)
         if self.predict_hrv_satellite:
-            hrv_sat_y_hat = self.model(inputs=x)
+            hrv_sat_y_hat = self(x)
             hrv_sat_y_hat = self.hrv_channel_change(hrv_sat_y_hat)
             # HRV Satellite losses
             hrv_sat_loss, sat_frame_loss = self.mse(hrv_sat_y_hat, y[HRV_KEY])
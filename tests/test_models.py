@@ -1,10 +1,15 @@
+from types import SimpleNamespace
+from unittest import mock
+
 import pytest
 import torch
 import yaml
 from nowcasting_dataset.consts import NWP_DATA, SATELLITE_DATA, TOPOGRAPHIC_DATA
 from nowcasting_utils.models.base import create_model, list_models
 
-from satflow.models import LitMetNet, Perceiver
+from satflow.models import EncoderDecoderConvLSTM, LitMetNet, Perceiver
+from satflow.models.cloudgan import CloudGAN
+from satflow.models.perceiverio import HRV_KEY, HuggingFacePerceiver
 
 
 def load_config(config_file):
@@ -61,6 +66,169 @@ def test_metnet_creation():
     assert not torch.isnan(out).any(), "Output included NaNs"
 
 
+def test_convlstm_creation():
+    config = load_config("satflow/configs/model/convlstm.yaml")
+    config.pop("_target_")  # This is only for Hydra
+    model = EncoderDecoderConvLSTM(**config)
+    x = torch.randn((2, 6, config["input_channels"], 16, 16))
+    model.eval()
+    with torch.no_grad():
+        out = model(x, config["forecast_steps"])
+    assert out.size() == (2, config["forecast_steps"], config["out_channels"], 16, 16)
+    assert not torch.isnan(out).any(), "Output included NaNs"
+
+
+def test_convlstm_scripted_matches_eager():
+    torch.manual_seed(0)
+    model = EncoderDecoderConvLSTM(hidden_dim=8, input_channels=3, out_channels=2, forecast_steps=3)
+    x = torch.randn((2, 4, 3, 8, 8))
+    assert model.model.scripted
+
+    def run():
+        model.zero_grad()
+        out = model(x, 3)
+        out.sum().backward()
+        return out.detach(), {n: p.grad.clone() for n, p in model.named_parameters()}
+
+    scripted_out, scripted_grads = run()
+    model.model.scripted = False
+    eager_out, eager_grads = run()
+    torch.testing.assert_close(scripted_out, eager_out, rtol=1e-5, atol=1e-6)
+    for name, grad in scripted_grads.items():
+        torch.testing.assert_close(grad, eager_grads[name], rtol=1e-4, atol=1e-5, msg=name)
+
+
+@pytest.mark.parametrize("loss", ["mse", "l1", "bce", torch.nn.SmoothL1Loss()])
+def test_convlstm_frame_losses(loss):
+    model = EncoderDecoderConvLSTM(
+        hidden_dim=8, input_channels=3, out_channels=2, forecast_steps=3, loss=loss
+    )
+    y_hat = torch.rand((2, 3, 2, 8, 8))
+    y = torch.rand((2, 3, 2, 8, 8))
+    expected = torch.stack([model.criterion(y_hat[:, f], y[:, f]) for f in range(3)])
+    torch.testing.assert_close(model.frame_losses(y_hat, y), expected)
+
+
+def test_convlstm_frame_loss_log_interval():
+    with pytest.raises(ValueError):
+        EncoderDecoderConvLSTM(frame_loss_log_interval=0)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA graphs need a GPU")
+def test_convlstm_cuda_graphs_match_eager():
+    torch.manual_seed(0)
+    model = EncoderDecoderConvLSTM(
+        hidden_dim=8, input_channels=3, out_channels=2, forecast_steps=3, cuda_graphs=True
+    ).cuda()
+    model.train()
+
+    def run(x):
+        model.zero_grad()
+        out = model(x, 3)
+        out.sum().backward()
+        return out.detach().clone(), {n: p.grad.clone() for n, p in model.named_parameters()}
+
+    # The first call captures the graph, the following ones replay it with new batch contents
+    for _ in range(3):
+        x = torch.randn((2, 4, 3, 8, 8), device="cuda")
+        graphed_out, graphed_grads = run(x)
+        model.cuda_graphs = False
+        eager_out, eager_grads = run(x)
+        model.cuda_graphs = True
+        torch.testing.assert_close(graphed_out, eager_out, rtol=1e-5, atol=1e-6)
+        for name, grad in graphed_grads.items():
+            torch.testing.assert_close(grad, eager_grads[name], rtol=1e-4, atol=1e-5, msg=name)
+    assert len(model.graphed_models) == 1
+
+
+def test_convlstm_decoder_conv2d():
+    model = EncoderDecoderConvLSTM(hidden_dim=8, input_channels=3, out_channels=2, forecast_steps=3)
+    decoder = model.model.decoder_CNN
+    assert isinstance(decoder, torch.nn.Conv2d)
+    # Checkpoints from the Conv3d decoder have a (out, hidden, 1, 3, 3) weight
+    state_dict = model.state_dict()
+    old_weight = torch.randn(2, 8, 1, 3, 3)
+    state_dict["model.decoder_CNN.weight"] = old_weight
+    model.load_state_dict(state_dict)
+    torch.testing.assert_close(decoder.weight, old_weight.squeeze(2))
+    # The per-frame Conv2d gives the same result as the Conv3d it replaced
+    conv3d = torch.nn.Conv3d(8, 2, kernel_size=(1, 3, 3), padding=(0, 1, 1))
+    with torch.no_grad():
+        conv3d.weight.copy_(decoder.weight.unsqueeze(2))
+        conv3d.bias.copy_(decoder.bias)
+        states = torch.randn(2, 3, 8, 8, 8)
+        expected = torch.sigmoid(conv3d(states.permute(0, 2, 1, 3, 4))).permute(0, 2, 1, 3, 4)
+        torch.testing.assert_close(model.model.decode(states), expected, rtol=1e-5, atol=1e-6)
+
+
+def test_convlstm_output_layout():
+    model = EncoderDecoderConvLSTM(hidden_dim=8, input_channels=3, out_channels=2, forecast_steps=5)
+    x = torch.randn((2, 4, 3, 8, 12))
+    out = model(x, 5)
+    # Time-major like the targets, so the losses need no permute
+    assert out.size() == (2, 5, 2, 8, 12)
+
+
+def test_cloudgan_discriminator_step_reuses_generated_images():
+    model = CloudGAN(
+        forecast_steps=1,
+        input_channels=2,
+        channels_per_timestep=2,
+        num_filters=8,
+        discriminator_model="pixel",
+    )
+    # Takes the (images, future_images) concatenation
+    model.discriminator = torch.nn.Conv2d(4, 1, kernel_size=1)
+    images = torch.randn((2, 2, 8, 8))
+    future_images = torch.randn((2, 2, 8, 8))
+    generated_images = torch.randn((2, 2, 8, 8))
+    model.cache_generated(generated_images, batch_idx=3)
+    with mock.patch.object(
+        model, "forward", side_effect=AssertionError("Generator was called")
+    ), mock.patch.object(model, "log_dict"), mock.patch.object(
+        model.discriminator, "forward", wraps=model.discriminator.forward
+    ) as discriminator:
+        model.train_all_timestep(images, future_images, optimizer_idx=1, batch_idx=3)
+    real, fake = [call.args[0] for call in discriminator.call_args_list]
+    torch.testing.assert_close(real, torch.cat((images, future_images), 1))
+    torch.testing.assert_close(fake, torch.cat((images, generated_images), 1))
+
+
+class StubFlowPerceiver(torch.nn.Module):
+    """Stands in for the pretrained optical flow Perceiver, returning (B, H, W, 2) logits"""
+
+    def __init__(self):
+        super().__init__()
+        self.flow = torch.nn.Conv2d(3, 2, kernel_size=1)
+
+    def forward(self, inputs):
+        return SimpleNamespace(logits=self.flow(inputs[:, 0]).permute(0, 2, 3, 1))
+
+
+@pytest.mark.parametrize("predict_satellite", [False, True])
+def test_hf_perceiver_step(predict_satellite):
+    with mock.patch(
+        "satflow.models.perceiverio.PerceiverForOpticalFlow.from_pretrained",
+        return_value=StubFlowPerceiver(),
+    ):
+        model = HuggingFacePerceiver(input_size=8, lr=0.01)
+    model.predict_satellite = predict_satellite
+    assert all(p.dtype == torch.float32 for p in model.parameters())
+    assert "model.flow.weight" in model.state_dict()
+    x = torch.randn((2, 2, 3, 8, 8))
+    out = model(x)
+    assert out.size() == (2, 2, 8, 8)
+    assert out.dtype == torch.float32
+    y = {HRV_KEY: torch.rand((2, 1, 8, 8)), SATELLITE_DATA: torch.rand((2, 11, 8, 8))}
+    with mock.patch.object(model, "log_dict"):
+        loss = model._train_or_validate_step((x, y), batch_idx=0)
+    assert torch.isfinite(loss)
+    loss.backward()
+    assert model.model.flow.weight.grad is not None
+    optimizer = model.configure_optimizers()
+    assert optimizer.defaults["lr"] == 0.01
+
+
 @pytest.mark.parametrize("model_name", list_models())
 def test_create_model(model_name):
     """